@@ -16,7 +16,7 @@ setup(
 	scripts = ['src/magellan'],
 	license = 'GNU GPL',
 	platforms = 'posix',
-	requires=['matplotlib (>=0.82)'],
+	requires=['matplotlib (>=0.82)', 'numpy'],
 	)
 
 if sys.argv[1] == 'clean':
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+batch.py - models many tracks with one configuration
+
+Copyright (C) 2008 Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, glob
+from multiprocessing import Pool
+from Magellan.data import *
+from Magellan.calc import *
+from Magellan.model import Model
+from Magellan import instrument
+from Magellan.plot import save_results, save_plot
+from Magellan.export import export_results
+
+_default_results = 'results'
+
+# Inputs shared by every track a worker process models. They are
+# handed to each worker once when the pool starts instead of once
+# for every track.
+_shared = {}
+
+def expand_tracks(patterns):
+    """
+    expands a list of track files and glob patterns into a
+    list of track files. Patterns that match nothing are kept
+    as they are so that missing files are reported when read.
+    """
+
+    track_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if matches:
+            track_files.extend(matches)
+        else:
+            track_files.append(pattern)
+
+    return track_files
+
+def output_names(track_files):
+    """
+    creates a unique output name for every track file from
+    its file name without extension. Tracks with the same
+    name (from different directories) get a number appended.
+    Returns a list of names in the same order as track_files.
+    """
+
+    names = []
+    used = set()
+    for track_file in track_files:
+        base = os.path.splitext(os.path.basename(track_file))[0]
+        name = base
+        number = 1
+        while name in used:
+            number += 1
+            name = '%s-%d' % (base, number)
+        used.add(name)
+        names.append(name)
+
+    return names
+
+def _init_worker(model, results_dir, figures=None, dpi=None, format=None,
+                 profile=False):
+    """
+    stores the inputs shared by all tracks in the worker process.
+    If profile is True the stages of every track are measured (see
+    Magellan.instrument) and their records returned with it.
+    """
+
+    _shared['model'] = model
+    _shared['results'] = results_dir
+    _shared['format'] = format
+    _shared['records'] = None
+    if profile:
+        _shared['records'] = []
+        instrument.add_hook(_shared['records'].append)
+    _shared['figures'] = figures
+    _shared['dpi'] = dpi
+
+def _model_track(job):
+    """
+    models a single track with the shared inputs and exports the
+    results (see export_results) into the results directory, along
+    with the results needed to plot it and the figure if a figure
+    format is shared. Returns the path to the first file exported,
+    or when profiling a tuple of it and the records of the stages.
+    """
+
+    (track_file, name) = job
+    prefix = os.path.join(_shared['results'], name)
+
+    (dist, deep, dist_anom, anom) = get_trackdata(track_file)
+    model = _shared['model']
+    (anom_model, mag_layer, faults_and_rifts) = model.run(dist, deep,
+                                                          dist_anom)
+
+    plot_parameters = {'thickness':model.parameters.thickness}
+    exported = export_results(prefix, dist, dist_anom, deep, anom, mag_layer,
+                              faults_and_rifts, anom_model, plot_parameters,
+                              _shared['format'])
+    save_results(prefix + '.result', dist, dist_anom, deep, anom, mag_layer,
+                 faults_and_rifts, anom_model, plot_parameters)
+    if _shared['figures'] is not None:
+        save_plot(prefix + '.' + _shared['figures'], dist, dist_anom, deep,
+                  anom, mag_layer, faults_and_rifts, anom_model,
+                  plot_parameters, _shared['dpi'])
+
+    records = _shared['records']
+    if records is None:
+        return exported[0]
+    result = (exported[0], records[:])
+    del records[:]
+    return result
+
+def run_batch(track_files, files, parameters, results_dir=None,
+              processes=None, cache=None, figures=None, dpi=None,
+              format=None):
+    """
+    models every track in track_files with one configuration.
+    files is a dictionary with the asymmetry, jump, magnetization,
+    spreadingrate and timescale files and parameters a dictionary
+    with the model parameters (thickness, inclination, ...) as
+    given on the command line or in a configuration file.
+    The input files are read and the spreading history computed
+    once, then the tracks are modelled by a pool of processes
+    (as many as there are cpus unless processes is given).
+    The results of each track are exported into results_dir in
+    format (see Magellan.export.export_results) with the prefix
+    <name>, where name comes from output_names, and the results to
+    plot it are written as <name>.result
+    (see Magellan.plot.render_plots). If figures is a format (png,
+    pdf, svg, ...) the figure is also drawn off screen to
+    <name>.<figures> with resolution dpi. The stages are memoized
+    in cache if it is given (see Model). Stages measured in the
+    worker processes are passed to the hooks of Magellan.instrument
+    in this process. Returns a list of the model files (<name>.model
+    or <name>.npz) written.
+    """
+
+    if results_dir is None: results_dir = _default_results
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+
+    # The spreading history does not depend on the track
+    model = Model(files, parameters, cache)
+    model.deltax()
+
+    jobs = zip(track_files, output_names(track_files))
+    shared = (model, results_dir, figures, dpi, format)
+
+    if processes == 1:
+        # Stages are measured by the hooks of this process
+        _init_worker(*shared)
+        return map(_model_track, jobs)
+
+    pool = Pool(processes, _init_worker, shared + (instrument.enabled(),))
+    try:
+        model_files = pool.map(_model_track, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    if instrument.enabled():
+        for (model_file, records) in model_files:
+            for record in records:
+                instrument.emit(record)
+        model_files = [model_file for (model_file, records) in model_files]
+
+    return model_files
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench.py - times the stages of magellan on synthetic data
+
+Copyright (C) 2008 Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage: python -m Magellan.bench [OPTION]...
+Options:
+      -o [FILE]\t write the timings to FILE (default bench.txt)
+      -p values\t numbers of track points (default 100,...,1000000)
+      -e values\t numbers of timeline events (default 10,...,10000)
+      -r value \t times every stage is run, the best is kept
+      -t value \t skip scales of a stage expected to take longer
+               \t than this many seconds
+      -s names \t time only these stages (comma separated)
+      --compare OLD NEW\t compare the timings in two files
+"""
+
+import os, sys, getopt, shutil, tempfile
+from timeit import default_timer
+import numpy as np
+from Magellan import data, calc
+from Magellan.data import *
+from Magellan.calc import *
+
+_default_output = 'bench.txt'
+_default_points = (10**2, 10**3, 10**4, 10**5, 10**6)
+_default_events = (10, 10**2, 10**3, 10**4)
+_default_repeats = 3
+_default_time_limit = 60.0
+# Stages which depend on the track are timed with this many timeline
+# events, and those which depend on the timeline with this many points
+_reference_events = 100
+_reference_points = 1000
+# Length of the synthetic tracks in km, whatever the number of points
+_track_length = 400.0
+# Model parameters of the anomaly model and the figure
+_parameters = {'thickness':0.5, 'inclination':75, 'declination':-16,
+               'azimuth':100, 'obliquity':30}
+
+def write_track(filename, points, seed=0):
+    """
+    writes a synthetic track file of points points, evenly spaced
+    over _track_length km centred on the ridge, with depth growing
+    away from the ridge plus some relief and a random anomaly
+    """
+
+    random = np.random.RandomState(seed)
+    distance = np.linspace(-_track_length/2, _track_length/2, points)
+    depth = (2.5 + 0.35*np.sqrt(np.abs(distance)/15.0) +
+             0.1*np.sin(distance) + 0.05*random.standard_normal(points))
+    anomaly = 200*random.standard_normal(points)
+    zeros = np.zeros(points)
+
+    np.savetxt(filename, np.column_stack((distance, zeros, zeros,
+                                          depth, anomaly)), '%.6f')
+
+def write_periods(directory, events, seed=0):
+    """
+    writes synthetic period files (timescale, spreadingrate,
+    asymmetry, magnetization and jump) into directory with events
+    changes in all. Most of them are polarity reversals, with one
+    in ten a change of spreading rate, asymmetry or magnetization
+    and one in a hundred a ridge jump. Returns a dictionary of the
+    files as used by Model.
+    """
+
+    random = np.random.RandomState(seed)
+    kinds = (('timescale', events - 3*(events//10) - events//100),
+             ('spreadingrate', max(events//10, 1)),
+             ('asymmetry', events//10), ('magnetization', events//10),
+             ('jump', events//100))
+    # The changes are spread over the same span of time in every file,
+    # with polarity reversals on average 0.3 Myr apart. The oldest
+    # change must set both the polarity and the spreading rate.
+    span = 0.3*kinds[0][1]
+
+    files = {}
+    for (kind, count) in kinds:
+        if count == 0:
+            continue
+        ends = np.cumsum(random.exponential(1.0, count))
+        ends *= span/ends[-1]
+        if kind == 'jump':
+            ends *= 0.9
+        starts = np.concatenate(([0], ends[:-1]))
+        if kind == 'timescale':
+            columns = (starts, ends)
+        elif kind == 'spreadingrate':
+            columns = (starts, ends, random.uniform(10, 60, count))
+        elif kind == 'asymmetry':
+            columns = (starts, ends, random.uniform(-0.2, 0.2, count))
+        elif kind == 'magnetization':
+            columns = (starts, ends, random.uniform(2, 20, count))
+        else:
+            columns = (ends, random.uniform(-10, 10, count))
+
+        files[kind] = os.path.join(directory, kind + '.dat')
+        np.savetxt(files[kind], np.column_stack(columns), '%.6f')
+
+    return files
+
+def _cold(filename):
+    """
+    forgets what has been read of a file (in memory and in its
+    binary cache) so that it is parsed anew
+    """
+
+    data._tables.clear()
+    if os.path.exists(filename + data._cache_suffix):
+        os.remove(filename + data._cache_suffix)
+
+class _Scale(object):
+    """
+    The synthetic inputs of one scale, created when first needed.
+    Each property is the input of a stage, computed by the stages
+    before it.
+    """
+
+    def __init__(self, directory, points, events):
+        self.directory = os.path.join(directory, '%d-%d' % (points, events))
+        os.makedirs(self.directory)
+        self.points = points
+        self.events = events
+        self._values = {}
+
+    def _value(self, name, compute):
+        if name not in self._values:
+            self._values[name] = compute()
+        return self._values[name]
+
+    @property
+    def track_file(self):
+        def compute():
+            filename = os.path.join(self.directory, 'track.xzm')
+            write_track(filename, self.points)
+            return filename
+        return self._value('track_file', compute)
+
+    @property
+    def files(self):
+        return self._value('files',
+                           lambda: write_periods(self.directory, self.events))
+
+    @property
+    def track(self):
+        return self._value('track',
+                           lambda: get_trackdata(self.track_file, False))
+
+    @property
+    def periods(self):
+        files = self.files
+        return self._value('periods', lambda: (
+            get_asymmetry(files.get('asymmetry')),
+            get_spreadingrate(files['spreadingrate']),
+            get_jumps(files.get('jump')),
+            get_magnetization(files.get('magnetization')),
+            get_timescale(files['timescale'])))
+
+    @property
+    def timeline(self):
+        return self._value('timeline',
+                           lambda: create_change_timeline(*self.periods))
+
+    @property
+    def deltax(self):
+        return self._value('deltax', lambda: create_deltax(self.timeline))
+
+    @property
+    def layer(self):
+        dist = self.track[0]
+        return self._value('layer', lambda: create_magnetized_layer(
+            self.deltax[0], self.deltax[1], min(dist), max(dist)))
+
+    @property
+    def projected_layer(self):
+        return self._value('projected_layer', lambda: calc._project_layer(
+            self.layer, resolve_parameters(_parameters).obliquity))
+
+# Each stage takes a _Scale, computes the inputs of the stage and
+# returns a function which runs the stage once on them. It may also
+# return a tuple of that function and one which is run (untimed)
+# before each run.
+
+def _stage_trackdata(scale):
+    track_file = scale.track_file
+    return lambda: get_trackdata(track_file, False)
+
+def _stage_timescale(scale):
+    timescale = scale.files['timescale']
+    return (lambda: get_timescale(timescale), lambda: _cold(timescale))
+
+def _stage_timeline(scale):
+    periods = scale.periods
+    return lambda: create_change_timeline(*periods)
+
+def _stage_deltax(scale):
+    timeline = scale.timeline
+    return lambda: create_deltax(timeline)
+
+def _stage_layer(scale):
+    (deltax_l, deltax_r) = scale.deltax
+    dist = scale.track[0]
+    (min_l, max_r) = (min(dist), max(dist))
+    return lambda: create_magnetized_layer(deltax_l, deltax_r, min_l, max_r)
+
+def _stage_anomaly_model(scale, engine=None):
+    (dist, deep, dist_anom, anom) = scale.track
+    layer = scale.projected_layer
+    parameters = dict(_parameters, engine=engine)
+    return lambda: create_anomaly_model(dist, deep, parameters, layer)
+
+def _stage_engine(engine):
+    """
+    returns the setup of the anomaly model stage with another engine
+    (see calc.register_engine, whose costs these stages measure)
+    """
+
+    return lambda scale: _stage_anomaly_model(scale, engine)
+
+def _stage_plot(scale):
+    # Raises ImportError without matplotlib, skipping the stage
+    import matplotlib
+    from Magellan.plot import save_plot
+
+    (dist, deep, dist_anom, anom) = scale.track
+    layer = scale.layer
+    # Any model draws as fast, computing one would take far longer
+    # than drawing it on long tracks
+    model = [0.0]*len(dist_anom)
+    filename = os.path.join(scale.directory, 'figure.png')
+    return lambda: save_plot(filename, dist, dist_anom, deep, anom,
+                             layer, [], model, _parameters)
+
+# The stages timed: (name, scaled by, order, setup), where scaled by is
+# either 'points' (of the track) or 'events' (of the timeline) and the
+# time of the stage is expected to grow as that number to the power
+# order (which tells when the next scale would take too long)
+stages = (
+    ('get_trackdata', 'points', 1, _stage_trackdata),
+    ('get_timescale', 'events', 1, _stage_timescale),
+    ('create_change_timeline', 'events', 1, _stage_timeline),
+    ('create_deltax', 'events', 1, _stage_deltax),
+    ('create_magnetized_layer', 'events', 1, _stage_layer),
+    ('create_anomaly_model', 'points', 2, _stage_anomaly_model),
+    ('wonbevis_model', 'points', 2, _stage_engine('wonbevis')),
+    ('parker_model', 'points', 1, _stage_engine('parker')),
+    ('create_plot', 'points', 1, _stage_plot),
+)
+
+def time_stage(run, repeats=_default_repeats, before=None):
+    """
+    runs a stage repeats times, calling before (if given) before
+    each run. Returns a tuple with the shortest and mean time in
+    seconds: (best, mean)
+    """
+
+    times = []
+    for repeat in range(repeats):
+        if before is not None:
+            before()
+        start = default_timer()
+        run()
+        times.append(default_timer() - start)
+
+    return (min(times), sum(times)/len(times))
+
+def run_benchmarks(points=_default_points, events=_default_events,
+                   repeats=_default_repeats, time_limit=_default_time_limit,
+                   names=None, report=None):
+    """
+    times every stage (or those named in names) at every scale.
+    Stages scaled by points are run with _reference_events events
+    and those scaled by events with _reference_points points. Scales
+    at which a stage is expected to take longer than time_limit
+    seconds (judging by its order and the scale before) are skipped,
+    as are all scales of a stage which cannot be run (create_plot
+    without matplotlib). report, if given, is called with every row
+    as it is timed. Returns a list of rows:
+    [(stage, points, events, repeats, best, mean)]
+    where best and mean are None for skipped scales.
+    """
+
+    directory = tempfile.mkdtemp(prefix='magellan-bench-')
+    scales = {}
+    def scale_of(size):
+        if size not in scales:
+            scales[size] = _Scale(directory, *size)
+        return scales[size]
+
+    rows = []
+    try:
+        for (name, scaled_by, order, setup) in stages:
+            if names is not None and name not in names:
+                continue
+            skip = False
+            if scaled_by == 'points':
+                sizes = [(count, _reference_events) for count in points]
+            else:
+                sizes = [(_reference_points, count) for count in events]
+            counts = [dict(zip(('points', 'events'), size))[scaled_by]
+                      for size in sizes]
+
+            for (number, size) in enumerate(sizes):
+                row = (name,) + size + (0, None, None)
+                if not skip and number > 0:
+                    growth = float(counts[number])/counts[number-1]
+                    skip = best*growth**order > time_limit
+                if not skip:
+                    try:
+                        run = setup(scale_of(size))
+                    except ImportError:
+                        skip = True
+                if not skip:
+                    before = None
+                    if isinstance(run, tuple):
+                        (run, before) = run
+                    (best, mean) = time_stage(run, repeats, before)
+                    row = (name,) + size + (repeats, best, mean)
+                rows.append(row)
+                if report is not None:
+                    report(row)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return rows
+
+def write_benchmarks(rows, output_file):
+    """
+    writes the rows of run_benchmarks to output_file, one row per
+    line with the columns separated by tabs. Skipped scales have
+    the times '-'.
+    """
+
+    f = open(output_file, 'w')
+    f.write('% stage\tpoints\tevents\trepeats\tbest(s)\tmean(s)\n')
+    for row in rows:
+        f.write(_format_row(row))
+    f.close()
+
+def read_benchmarks(input_file):
+    """
+    reads benchmarks written by write_benchmarks. Returns a
+    dictionary {(stage, points, events):best}, where best is None
+    for skipped scales.
+    """
+
+    timings = {}
+    for line in open(input_file).read().splitlines():
+        if line.startswith('%') or not line.strip():
+            continue
+        (stage, points, events, repeats, best, mean) = line.split('\t')
+        if best == '-': best = None
+        else: best = float(best)
+        timings[(stage, int(points), int(events))] = best
+
+    return timings
+
+def compare_benchmarks(old_file, new_file):
+    """
+    compares two files written by write_benchmarks. Returns a list
+    of the scales timed in both, in the order of new_file, with the
+    best times and how many times faster the new one is:
+    [(stage, points, events, old_best, new_best, speedup)]
+    """
+
+    old = read_benchmarks(old_file)
+    new = read_benchmarks(new_file)
+
+    rows = []
+    for line in open(new_file).read().splitlines():
+        if line.startswith('%') or not line.strip():
+            continue
+        (stage, points, events) = line.split('\t')[:3]
+        key = (stage, int(points), int(events))
+        if old.get(key) is None or new[key] is None:
+            continue
+        speedup = old[key]/max(new[key], 1e-9)
+        rows.append(key + (old[key], new[key], speedup))
+
+    return rows
+
+def _format_row(row):
+    (stage, points, events, repeats, best, mean) = row
+    if best is None:
+        return '%s\t%d\t%d\t%d\t-\t-\n' % (stage, points, events, repeats)
+    return '%s\t%d\t%d\t%d\t%.6g\t%.6g\n' % row
+
+def _parse_counts(text):
+    return [int(float(value)) for value in text.split(',')]
+
+def main(arguments):
+    try:
+        opts, args = getopt.getopt(arguments, "o:p:e:r:t:s:h",
+                                   ["output=", "points=", "events=",
+                                    "repeats=", "timelimit=", "stages=",
+                                    "compare", "help"])
+    except getopt.GetoptError:
+        print __doc__.split('Usage:')[1].strip()
+        return 2
+
+    output_file = _default_output
+    options = {}
+    compare = False
+    for o, a in opts:
+        if o in ("-o", "--output"):
+            output_file = a
+        if o in ("-p", "--points"):
+            options['points'] = _parse_counts(a)
+        if o in ("-e", "--events"):
+            options['events'] = _parse_counts(a)
+        if o in ("-r", "--repeats"):
+            options['repeats'] = int(a)
+        if o in ("-t", "--timelimit"):
+            options['time_limit'] = float(a)
+        if o in ("-s", "--stages"):
+            options['names'] = a.split(',')
+        if o == "--compare":
+            compare = True
+        if o in ("-h", "--help"):
+            print "Usage:", __doc__.split('Usage:')[1].strip()
+            return 0
+
+    if compare:
+        if len(args) != 2:
+            print "--compare needs the OLD and NEW timing files"
+            return 2
+        for (stage, points, events, old, new, speedup) in \
+                compare_benchmarks(*args):
+            print '%-24s %8d %6d %10.4g %10.4g %7.2fx' % (
+                stage, points, events, old, new, speedup)
+        return 0
+
+    def report(row):
+        sys.stdout.write(_format_row(row))
+        sys.stdout.flush()
+
+    rows = run_benchmarks(report=report, **options)
+    write_benchmarks(rows, output_file)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+cache.py - on-disk memoization of pipeline stages.
+
+Copyright (C) 2008  Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, hashlib
+import cPickle as pickle
+import numpy as np
+
+_default_cache_dir = os.path.join('~', '.magellan', 'cache')
+# Maximum size of a stage cache in megabytes
+_default_cache_size = 256
+# Changed whenever the output of a stage changes, so results of an
+# older version are never read back
+_stage_version = 1
+_suffix = '.pickle'
+
+def digest(*values):
+    """
+    returns a hexadecimal SHA-1 digest of values, which may be
+    numbers, strings, None, numpy arrays and tuples, lists and
+    dictionaries of those. Equal values have equal digests.
+    """
+
+    sha = hashlib.sha1()
+    _update(sha, (_stage_version,) + values)
+    return sha.hexdigest()
+
+def file_digest(filename):
+    """
+    returns a digest of the content of a file, or of None if
+    filename is None
+    """
+
+    if filename is None:
+        return digest(None)
+
+    sha = hashlib.sha1()
+    f = open(os.path.expanduser(filename), 'rb')
+    try:
+        block = f.read(1 << 20)
+        while block:
+            sha.update(block)
+            block = f.read(1 << 20)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def _update(sha, value):
+    """
+    feeds value into the hash sha, tagged with its type so that
+    e.g. the string '1' and the number 1 differ
+    """
+
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        sha.update('a%s%r' % (value.dtype.str, value.shape))
+        sha.update(value.tostring())
+    elif isinstance(value, dict):
+        sha.update('d%d' % len(value))
+        for key in sorted(value):
+            _update(sha, key)
+            _update(sha, value[key])
+    elif isinstance(value, (tuple, list)):
+        sha.update('l%d' % len(value))
+        for item in value:
+            _update(sha, item)
+    else:
+        # repr of floats is exact, so equal digests mean equal numbers
+        text = repr(value)
+        sha.update('v%d%s' % (len(text), text))
+
+class StageCache(object):
+    """
+    A directory of pickled pipeline results, each stored under the
+    digest of everything it was computed from. The cache holds at
+    most max_size megabytes; when it grows beyond that the least
+    recently used results are removed. Several processes may share
+    a cache directory. Results which cannot be written (e.g. in a
+    read only directory) are simply not cached.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None: directory = _default_cache_dir
+        if max_size is None: max_size = _default_cache_size
+        self.directory = os.path.expanduser(directory)
+        self.max_size = int(float(max_size)*(1 << 20))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _suffix)
+
+    def get(self, key):
+        """
+        returns a tuple telling whether the result of key is cached
+        and the result: (found, value)
+        """
+
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return (False, None)
+        try:
+            try:
+                value = pickle.load(f)
+            except Exception:
+                # Half written by a process which died or corrupted
+                return (False, None)
+        finally:
+            f.close()
+
+        # The modification time is when the result was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return (True, value)
+
+    def put(self, key, value):
+        """
+        stores the result of key and removes the least recently
+        used results if the cache has grown too large
+        """
+
+        path = self._path(key)
+        temporary = '%s.%d' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            f = open(temporary, 'wb')
+            try:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(temporary, path)
+        except (IOError, OSError):
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+
+        self.evict()
+
+    def memoize(self, key, compute):
+        """
+        returns the result of key, calling compute() to create
+        it if it is not in the cache
+        """
+
+        (found, value) = self.get(key)
+        if not found:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """
+        removes the least recently used results until the cache is
+        no larger than its maximum size
+        """
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(_suffix): continue
+            try:
+                status = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((status.st_mtime, status.st_size, name))
+            total += status.st_size
+
+        entries.sort()
+        for (used, size, name) in entries:
+            if total <= self.max_size: break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        removes every result in the cache
+        """
+
+        if not os.path.isdir(self.directory): return
+        for name in os.listdir(self.directory):
+            if name.endswith(_suffix):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
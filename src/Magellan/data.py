@@ -20,52 +20,97 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os,sys,re
+import numpy as np
 import Magellan
+from Magellan import instrument
 
 # Filenames for default files
 data_path = os.path.split(Magellan.__file__)[0]
 _default_timescale = os.path.join(data_path, 'data', 'Lourens2004.dat')
 
-def _read_period_file(period_file, key_column, value_column):
+# Binary cache files of track and period data
+_cache_suffix = '.cache.npy'
+_cache_version = 1
+# Period tables already read, {absolute filepath:(stamp, table)}
+_tables = {}
+
+def read_periods(period_file, cache=True):
     """
-    A generator function which reads information from files
-    with time periods and a specific value for those periods
+    reads a file with time periods and a specific value for
+    those periods in a single pass. Returns a tuple of three
+    arrays, sorted by the start of the periods:
+    (start_of_period, end_of_period, value_of_period)
+    Missing or non-numerical columns (e.g. the names of the
+    periods in a timescale) are NaN. Files with only two columns,
+    such as jump files, have their second column as the end.
+
     Theoretically it can be used for similar, non-time period
-    files since it returns the content of given columns (through
-    the parameters key_column and value_column). Returns a tuple
-    containing the evaluated value of the key column and the
-    value column
+    files. The result is remembered for as long as the file is
+    unchanged, both in memory and in a binary cache file next to
+    it, unless cache is False.
     """
 
-    filepath = os.path.expanduser(period_file)
-    file_content = open(filepath).read()
-    lines = file_content.splitlines()
-    
-    for line in lines:
-        """
-        Format of files:
-        period_start period_end value
+    with instrument.stage('read_periods'):
+        table = _cached_table(os.path.expanduser(period_file), _parse_periods,
+                              cache, remember=True)
+        instrument.count('rows', len(table))
+    return (table[:,0], table[:,1], table[:,2])
 
-        where
-        period_start is start of period in myrs (million years)
-        period_end   is end of period in myrs
-        value        is the value for that period
+def _parse_periods(filepath):
+    """
+    parses a period file into an array with a row for each period
+    and the columns start, end and value, sorted by start.
 
-        % at start of line is a comment
-        
-        Observe that period_end is only for the user's convenience
-        and the only period_start is used to indicate the asymmetry
-        of a period until next period starts
-        """
+    Format of files:
+    period_start period_end value
+
+    where
+    period_start is start of period in myrs (million years)
+    period_end   is end of period in myrs
+    value        is the value for that period
 
+    % at start of line is a comment
+    
+    Observe that period_end is only for the user's convenience
+    and the only period_start is used to indicate the asymmetry
+    of a period until next period starts
+    """
+
+    rows = []
+    for line in open(filepath).read().splitlines():
         #Ignore comments and blank lines
-        if re.match('^(%)|(\s*$)',line):
+        if line.startswith('%') or not line.strip():
             continue
 
-        #Split line into columns
-        columns = line.split()
+        #Split line into the first three columns
+        columns = (line.split() + [None, None])[:3]
+        rows.append([_number(column) for column in columns])
 
-        yield (eval(columns[key_column]), eval(columns[value_column]))
+    table = np.array(rows, dtype=float).reshape(len(rows), 3)
+    return table[np.argsort(table[:,0], kind='mergesort')]
+
+def _number(text):
+    """
+    returns text as a number, or NaN if it is not a number
+    """
+
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+def get_period_table(period_file):
+    """
+    retrieves the periods of a period file as they are written
+    in the file (sorted by start), e.g. to adjust and write them
+    back. Returns a
+    list of tuples:
+    [(start_of_period, end_of_period, value_of_period)]
+    """
+
+    (start, end, value) = read_periods(period_file)
+
+    return zip(start.tolist(), end.tolist(), value.tolist())
 
 def get_asymmetry(asymmetry_file=None, key_name='asymmetry'):
     """
@@ -81,7 +126,8 @@ def get_asymmetry(asymmetry_file=None, key_name='asymmetry'):
 
     asymmetry = {}
 
-    for (key,value) in _read_period_file(asymmetry_file,1,2):
+    (start, end, value) = read_periods(asymmetry_file)
+    for (key,value) in zip(end.tolist(), value.tolist()):
         asymmetry[-key] = {key_name:value}
 
     return asymmetry
@@ -116,7 +162,9 @@ def get_jumps(jump_file=None):
 
     jumps = {}
 
-    for (key,value) in _read_period_file(jump_file,0,1):
+    # Jump files have two columns, the time and the distance
+    (time, distance, unused) = read_periods(jump_file)
+    for (key,value) in zip(time.tolist(), distance.tolist()):
         jumps[-key] = {'jump':value}
    
     return jumps
@@ -133,7 +181,8 @@ def get_spreadingrate(spreadingrate_file):
 
     spr_rates = {}
     
-    for (key,value) in _read_period_file(spreadingrate_file,1,2):
+    (start, end, value) = read_periods(spreadingrate_file)
+    for (key,value) in zip(end.tolist(), value.tolist()):
         spr_rates[-key] = {'spreadingrate':(value/2)}
 
     return spr_rates
@@ -152,15 +201,10 @@ def get_timescale(timescale=None):
 
     reversed_timescale = {}
     
-    filepath = os.path.expanduser(timescale)
-    file_content = open(filepath).read()
-    lines = file_content.splitlines()
+    (start, end, names) = read_periods(timescale)
 
-    number_of_periods = len(lines)
-    #if ((number_of_periods % 2) == 0): polarity = 'r'
-    #else: polarity = 'n'
     polarity='n'
-    for (key,value) in _read_period_file(filepath,1,0):
+    for key in end.tolist():
         reversed_timescale[-key] = {'polarity':polarity}
 
         #Swap polarities
@@ -170,50 +214,27 @@ def get_timescale(timescale=None):
     return reversed_timescale
 
 
-def get_trackdata(input_file):
+def get_trackdata(input_file, cache=True):
     """
     gathers data from track file. Input file must be
     provided. Data gathered is distance, anomaly and
-    depth. Returns...
+    depth. The track is padded with 20 points (1 km apart)
+    at both ends. Returns a tuple of lists:
+    (padded distance, padded depth, distance, anomaly)
+    If cache is True the columns are kept in a binary cache
+    file next to the track file (see read_track_columns).
     """
-    
-    distance = []
-    anomaly = []
-    depth = []
-    distance = []
-    depth = []
-
-    filepath = os.path.expanduser(input_file)
-    file_content = open(filepath).read()
-    lines = file_content.splitlines()
-    for line in lines:
-        """
-        Format of file:
-        distance longtitude latitude depth anomaly
-
-        where
-        distance   is the distance in kilometers
-        longtitude is longditude coordinate (not needed)
-        latitude  is latitude coordinate (not needed)
-        depth      is depth in kilometers from ocean top (must be negated)
-        anomaly    is anomaly of magnetic measurements in nanoTesla
 
-        % at start of line is a comment
-        """
-
-        # Ignore comments and blank lines
-        if re.match('^(%)|(\s*$)',line):
-            continue
-        
-        columns = line.split()
-        distance.append(eval(columns[0])) # Evaluate as number
-        depth.append(eval(columns[3])) # Evaluate as number and negate
-        anomaly.append(eval(columns[4])) # Evaluate as number
+    (distance, depth, anomaly) = read_track_columns(input_file, cache)
 
     if distance[0] > distance[1]:
-	distance.reverse()
-	depth.reverse()
-	anomaly.reverse()
+        distance = distance[::-1]
+        depth = depth[::-1]
+        anomaly = anomaly[::-1]
+    distance = distance.tolist()
+    depth = depth.tolist()
+    anomaly = anomaly.tolist()
+
     # Extending the bathymetry 20 kms in both directions to avoid edge affects.
     depth_calc = [depth[0]]*20 + depth + [depth[-1]]*20
     distance_first = [distance[0] - x for x in range(1,21)]
@@ -222,6 +243,113 @@ def get_trackdata(input_file):
    
     return (distance_calc, depth_calc, distance, anomaly)
 
+def read_track_columns(input_file, cache=True):
+    """
+    reads the distance, depth and anomaly columns of a track
+    file (in the order of the file) into arrays. Returns a
+    tuple of arrays: (distance, depth, anomaly)
+
+    If cache is True the columns are also written to a binary
+    cache file, input_file + '.cache.npy', which is memory
+    mapped instead of parsing the track the next time it is
+    read. The cache is only used while the size and modification
+    time of the track file are the same as when it was written.
+    """
+
+    with instrument.stage('read_track'):
+        table = _cached_table(os.path.expanduser(input_file), _parse_track,
+                              cache)
+        instrument.count('rows', len(table))
+    return (table[:,0], table[:,1], table[:,2])
+
+def _cached_table(filepath, parse, cache=True, remember=False):
+    """
+    returns the array (with three columns) which parse(filepath)
+    returns. If cache is True the array is also written to a binary
+    cache file, filepath + '.cache.npy', which is memory mapped
+    instead of parsing the file the next time it is read. If
+    remember is True the array is also kept in memory. Both are
+    only used while the size and modification time of the file are
+    the same as when they were made.
+    """
+
+    cache_path = filepath + _cache_suffix
+    status = os.stat(filepath)
+    # First row of the cache identifies the file it was made from
+    stamp = (status.st_size, status.st_mtime, _cache_version)
+
+    key = os.path.abspath(filepath)
+    if cache and remember and key in _tables:
+        (table_stamp, table) = _tables[key]
+        if table_stamp == stamp:
+            return table
+
+    table = None
+    if cache and os.path.exists(cache_path):
+        try:
+            cached = np.load(cache_path, mmap_mode='r')
+            if cached.shape[1:] == (3,) and tuple(cached[0]) == stamp:
+                table = cached[1:]
+        except (IOError, OSError, ValueError):
+            pass
+
+    if table is None:
+        table = parse(filepath)
+
+        if cache:
+            _write_cache(cache_path, np.vstack((stamp, table)))
+
+    if cache and remember:
+        table.flags.writeable = False
+        _tables[key] = (stamp, table)
+
+    return table
+
+def _write_cache(cache_path, table):
+    """
+    writes table to the binary cache file cache_path, through a
+    temporary file so a cache is never half written
+    """
+
+    temporary = '%s.%d' % (cache_path, os.getpid())
+    try:
+        f = open(temporary, 'wb')
+        try:
+            np.save(f, table)
+        finally:
+            f.close()
+        os.rename(temporary, cache_path)
+    except (IOError, OSError):
+        # The cache is only an optimization, e.g. for read only directories
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def _parse_track(filepath):
+    """
+    parses a track file into an array with a row for each point
+    and the columns distance, depth and anomaly.
+
+    Format of file:
+    distance longtitude latitude depth anomaly
+
+    where
+    distance   is the distance in kilometers
+    longtitude is longditude coordinate (not needed)
+    latitude  is latitude coordinate (not needed)
+    depth      is depth in kilometers from ocean top (must be negated)
+    anomaly    is anomaly of magnetic measurements in nanoTesla
+
+    % at start of line is a comment
+    """
+
+    lines = open(filepath).read().splitlines()
+    # Ignore comments and blank lines, numbers are converted by numpy
+    columns = [line.split() for line in lines
+               if not line.startswith('%') and line.strip()]
+    rows = [(row[0], row[3], row[4]) for row in columns]
+
+    return np.array(rows, dtype=float).reshape(len(rows), 3)
+
 def get_configurations(config_file=None):
     """
     Go through a configuration file (project file)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+"""
+export.py - writes the results of magellan to files
+
+Copyright (C) 2008 Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import numpy as np
+from Magellan import instrument
+from Magellan.calc import resolve_parameters
+from Magellan.plot import create_block_polygons
+
+# gmt writes text files which GMT (psxy, ...) reads directly,
+# binary one numpy .npz file with every column
+formats = ('gmt', 'binary')
+_default_format = 'gmt'
+_default_prefix = 'magellan'
+# Floats are written with as many digits as str() gives them
+_number = '%.12g'
+
+@instrument.measured('export')
+def export_results(prefix, dist, dist_anom, deep, anom, layer, faultrift,
+                   model, parameters, format=None):
+    """
+    writes the results of modelling a track to files named prefix
+    followed by an extension. dist and deep are the padded track
+    (see get_trackdata), dist_anom and anom the track as it was read
+    and model the anomaly at dist_anom (or at dist, see
+    model_columns); only the points of the track as it was read are
+    written. The thickness of the blocks is taken from parameters.
+
+    The gmt format writes
+    prefix.model (distance, model, anomaly and depth),
+    prefix.residual (distance and anomaly minus model),
+    prefix.blocks (a GMT multisegment file of the magnetized blocks
+    beneath the track, filled black when normally polarized and
+    white when reversed),
+    prefix.pf (distances of pseudo faults) and
+    prefix.fr (distances of failed rifts).
+    The binary format writes everything into prefix.npz
+    (see load_export). Returns a list of the files written.
+    """
+
+    if format is None: format = _default_format
+    if format not in formats:
+        raise ValueError('unknown format %s, choose one of %s'
+                         % (format, ', '.join(formats)))
+
+    thickness = resolve_parameters(parameters).thickness
+    columns = model_columns(dist, dist_anom, deep, anom, model)
+    instrument.count('rows', len(dist_anom))
+    (polygons, normal) = _track_blocks(dist, deep, dist_anom, layer,
+                                       thickness)
+    faults = np.array([position for (position,fault,rift) in faultrift
+                       if fault], dtype=float)
+    rifts = np.array([position for (position,fault,rift) in faultrift
+                      if rift], dtype=float)
+
+    directory = os.path.dirname(prefix)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    if format == 'binary':
+        (block_x, block_y, block_offsets) = _pack_polygons(polygons)
+        filename = prefix + '.npz'
+        f = open(filename, 'wb')
+        try:
+            np.savez(f, block_x=block_x, block_y=block_y,
+                     block_offsets=block_offsets, block_normal=normal,
+                     pseudofaults=faults, failedrifts=rifts, **columns)
+        finally:
+            f.close()
+        return [filename]
+
+    files = [prefix + extension for extension in
+             ('.model', '.residual', '.blocks', '.pf', '.fr')]
+    _write(files[0], format_rows((columns['distance'], columns['model'],
+                                  columns['anomaly'], columns['depth'])))
+    _write(files[1], format_rows((columns['distance'],
+                                  columns['residual'])))
+    _write(files[2], format_segments(polygons, normal))
+    export_faults(prefix, faultrift)
+
+    return files
+
+def export_faults(prefix, faultrift):
+    """
+    writes the distances of the pseudo faults to prefix.pf and
+    of the failed rifts to prefix.fr, one per line. Returns a
+    list of the files written.
+    """
+
+    files = [prefix + '.pf', prefix + '.fr']
+    for (filename, kind) in zip(files, (1, 2)):
+        _write(filename, format_rows(([fr[0] for fr in faultrift
+                                       if fr[kind]],)))
+    return files
+
+class ModelStream(object):
+    """
+    Writes prefix.model and prefix.residual (see export_results) as
+    the model is computed, a part at a time, for models too long to
+    keep. dist, deep, dist_anom and anom are as for export_results.
+    The parts are the model at dist_anom, given to write in order
+    of distance, and must together cover it.
+    """
+
+    def __init__(self, prefix, dist, dist_anom, deep, anom):
+        pad = (len(dist) - len(dist_anom)) // 2
+        self.dist_anom = np.asarray(dist_anom, dtype=float)
+        self.anom = np.asarray(anom, dtype=float)
+        self.deep = np.asarray(deep, dtype=float)[pad:pad+len(dist_anom)]
+        # Index of the next point of dist_anom
+        self.index = 0
+        self.model_file = open(prefix + '.model', 'w')
+        self.residual_file = open(prefix + '.residual', 'w')
+
+    def write(self, values):
+        """
+        writes the next values of the model along the track
+        """
+
+        model = np.asarray(values, dtype=float)
+        (first, last) = (self.index, self.index + len(model))
+        self.index = last
+        if first >= last:
+            return
+
+        (dist_anom, anom) = (self.dist_anom[first:last], self.anom[first:last])
+        self.model_file.write(format_rows(
+            (dist_anom, model, anom, self.deep[first:last])))
+        self.residual_file.write(format_rows((dist_anom, anom - model)))
+
+    def close(self):
+        self.model_file.close()
+        self.residual_file.close()
+
+def load_export(filename):
+    """
+    reads the results written by export_results in the binary
+    format. Returns a dictionary of arrays with the columns
+    distance, model, anomaly, residual and depth, the distances of
+    pseudofaults and failedrifts, block_normal telling which
+    blocks are normally polarized and blocks, a list of (n,2)
+    arrays with the outline of each block.
+    """
+
+    f = open(filename, 'rb')
+    try:
+        archive = np.load(f)
+        results = dict([(key, archive[key]) for key in archive.files])
+    finally:
+        f.close()
+
+    offsets = results.pop('block_offsets')
+    results['blocks'] = [np.column_stack((x, y)) for (x, y) in zip(
+        np.split(results.pop('block_x'), offsets[1:]),
+        np.split(results.pop('block_y'), offsets[1:]))]
+
+    return results
+
+def model_columns(dist, dist_anom, deep, anom, model):
+    """
+    returns the columns of the model at the points of the track
+    as it was read (dist_anom), leaving out the padding of dist and
+    deep. model is the anomaly at dist_anom, or at dist, in which
+    case its padding is left out too. Returns a dictionary of
+    arrays: distance, model, anomaly, residual (anomaly minus model)
+    and depth.
+    """
+
+    pad = (len(dist) - len(dist_anom)) // 2
+    count = len(dist_anom)
+    model = np.asarray(model, dtype=float)
+    if len(model) != count:
+        model = model[pad:pad+count]
+    anom = np.asarray(anom, dtype=float)
+
+    return {'distance':np.asarray(dist_anom, dtype=float),
+            'model':model,
+            'anomaly':anom,
+            'residual':anom - model,
+            'depth':np.asarray(deep, dtype=float)[pad:pad+count]}
+
+def format_rows(columns):
+    """
+    returns the text of a table with the given columns, one row
+    per line with the values separated by spaces
+    """
+
+    columns = [np.asarray(column, dtype=float) for column in columns]
+    if len(columns[0]) == 0:
+        return ''
+    row = ' '.join([_number]*len(columns)) + '\n'
+    return ''.join([row % values
+                    for values in zip(*[column.tolist()
+                                        for column in columns])])
+
+def format_segments(polygons, normal):
+    """
+    returns the text of a GMT multisegment file of the polygons,
+    each headed by a fill of black if it is normal and white
+    otherwise
+    """
+
+    segments = []
+    for (polygon, is_normal) in zip(polygons, normal):
+        if is_normal: segments.append('> -Gblack\n')
+        else: segments.append('> -Gwhite\n')
+        segments.append(format_rows((polygon[:,0], polygon[:,1])))
+    return ''.join(segments)
+
+def _write(filename, text):
+    """
+    writes text to filename in one go
+    """
+
+    f = open(filename, 'w')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+def _track_blocks(dist, deep, dist_anom, layer, thickness):
+    """
+    returns the outlines of the blocks which lie beneath the
+    track as it was read (see create_block_polygons)
+    """
+
+    (polygons, normal) = create_block_polygons(dist, deep, layer, thickness)
+    if len(dist_anom) == 0:
+        return ([], normal[:0])
+
+    (first, last) = (dist_anom[0], dist_anom[-1])
+    beneath = np.array([i for (i, ((start,end),polarity,magnet))
+                        in enumerate(layer)
+                        if end >= first and start <= last], dtype=int)
+    return ([polygons[i] for i in beneath], normal[beneath])
+
+def _pack_polygons(polygons):
+    """
+    packs the corners of polygons into two arrays and the offset
+    of the first corner of each polygon: (x, y, offsets)
+    """
+
+    if len(polygons) == 0:
+        return (np.zeros(0), np.zeros(0), np.zeros(0, dtype=int))
+    lengths = np.array([len(polygon) for polygon in polygons])
+    corners = np.concatenate(polygons)
+    return (corners[:,0], corners[:,1], np.cumsum(lengths) - lengths)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+"""
+fit.py - fits spreading rates and asymmetry to a track
+
+Copyright (C) 2008 Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from math import cos, sqrt
+import numpy as np
+from Magellan.data import *
+from Magellan.calc import *
+from Magellan import calc
+
+_default_evaluations = 2000
+# Initial and smallest steps of the search, relative to the
+# spreading rate and absolute for the asymmetry
+_rate_step = (0.1, 0.001)
+_asymmetry_step = (0.05, 0.001)
+# Largest kernel (observation points times segments) kept between
+# evaluations, 2**25 floats take 256 MB
+_kernel_size = 2**25
+
+class CachedForwardModel(object):
+    """
+    A forward model of one track where only the spreading rates
+    and asymmetry change between evaluations. Everything else is
+    computed once: the timescale, jumps and magnetization are read,
+    the track is projected and the anomaly of every segment of the
+    bathymetry (for a unit magnetic field) is kept in a matrix.
+    An evaluation then only builds the magnetized layer from the
+    periods and multiplies the matrix with the magnetic field of
+    each segment. The matrix grows with the square of the length of
+    the track; beyond _kernel_size it is not kept but computed anew
+    in blocks of rows for every evaluation, for the magnetized
+    segments only, which is much slower. Misfits are remembered for
+    every period table already evaluated.
+    """
+
+    def __init__(self, track_file, files, parameters):
+        (thickness, declination, inclination, azimuth, obliquity,
+         engine) = resolve_parameters(parameters)[:6]
+
+        self.jump = get_jumps(files['jump'])
+        self.magnet = get_magnetization(files['magnetization'])
+        self.timescale = get_timescale(files['timescale'])
+
+        (dist, deep, dist_anom, anom) = get_trackdata(track_file)
+        self.dist = dist
+        self.anom = np.array(anom, dtype=float)
+        self.factor = cos(obliquity)
+        self.projected_dist = [distance*self.factor for distance in dist]
+
+        # The model is only needed where the anomaly is observed
+        x = np.array(self.projected_dist)
+        z = np.array(deep, dtype=float)
+        observations = np.array(dist_anom, dtype=float)*self.factor
+        (x1, z1, x2, z2) = (x[:-1], z[:-1], x[1:], z[1:])
+        # Segments of zero length enclose no area and contribute nothing
+        empty = (x1 == x2) & (z1 == z2)
+        # The kernel needs the terms of every segment, an engine
+        # without them is replaced by talwani (see calc._engine)
+        self.terms = calc._engine(engine, x, z, polygon=True,
+                                  observations=observations).terms
+        self.segments = (x1, z1, x2, z2)
+        self.empty = empty
+        self.observations = observations
+        self.field = (thickness, inclination, declination, azimuth)
+
+        # Too large a kernel is computed anew, block by block, for
+        # every evaluation instead of being kept
+        self.kernel = None
+        if len(observations)*len(x1) <= _kernel_size:
+            self.kernel = self.kernel_rows(slice(None))
+
+        self.misfits = {}
+
+    def kernel_rows(self, rows, columns=None):
+        """
+        computes the rows (observation points) of the kernel, the
+        anomaly of every segment for a unit magnetic field, or only
+        the columns given (a boolean array over the segments)
+        """
+
+        (x1, z1, x2, z2) = self.segments
+        empty = self.empty
+        if columns is not None:
+            (x1, z1, x2, z2) = (x1[columns], z1[columns], x2[columns],
+                                z2[columns])
+            empty = empty[columns]
+        (thickness, inclination, declination, azimuth) = self.field
+        observations = self.observations[rows]
+
+        kernel = np.zeros((len(observations), len(x1)))
+        step = max(1, calc._talwani_block_size // max(1, len(x1)))
+        old_settings = np.seterr(divide='ignore', invalid='ignore')
+        try:
+            for first in range(0, len(observations), step):
+                block = slice(first, first+step)
+                (P, Q) = self.terms(x1, z1, x2, z2, observations[block],
+                                    thickness, calc._contam)
+                kernel[block] = calc._talwani_field(P, Q, inclination,
+                                                    declination, azimuth)
+        finally:
+            np.seterr(**old_settings)
+        kernel[:,empty] = 0
+        # Back to the original track
+        return kernel/self.factor
+
+        self.misfits = {}
+
+    def model(self, spread_table, asym_table):
+        """
+        computes the anomaly at the observed points for the
+        periods in spread_table and asym_table (see
+        get_period_table). Returns an array of anomalies.
+        """
+
+        # Same dictionaries as get_spreadingrate and get_asymmetry return
+        spread = {}
+        for (start, end, rate) in spread_table:
+            spread[-end] = {'spreadingrate':(rate/2)}
+        asym = {}
+        for (start, end, asymmetry) in asym_table:
+            asym[-end] = {'asymmetry':asymmetry}
+
+        timeline = iter_change_timeline(asym, spread, self.jump,
+                                        self.magnet, self.timescale)
+        (delta_l, delta_r) = create_deltax(timeline)
+        mag_layer = create_magnetized_layer(delta_l, delta_r,
+                                            min(self.dist), max(self.dist))
+        projected_mag_layer = [((start*self.factor, end*self.factor),
+                                polarity, magnet)
+                               for ((start,end),polarity,magnet) in mag_layer]
+
+        (in_layer, mag_field) = calc._segment_fields(self.projected_dist,
+                                                     projected_mag_layer)
+        if self.kernel is not None:
+            return np.dot(self.kernel, mag_field)
+
+        # Only the segments within the layer contribute
+        magnetized = mag_field != 0
+        anomaly = np.zeros(len(self.observations))
+        step = max(1, _kernel_size // max(1, magnetized.sum()))
+        for first in range(0, len(anomaly), step):
+            block = slice(first, first+step)
+            anomaly[block] = np.dot(self.kernel_rows(block, magnetized),
+                                    mag_field[magnetized])
+        return anomaly
+
+    def misfit(self, spread_table, asym_table):
+        """
+        returns the root mean square difference between the model
+        for the periods in spread_table and asym_table and the
+        observed anomaly
+        """
+
+        key = (tuple(spread_table), tuple(asym_table))
+        if key not in self.misfits:
+            difference = self.model(spread_table, asym_table) - self.anom
+            self.misfits[key] = sqrt(np.mean(difference**2))
+
+        return self.misfits[key]
+
+def fit_spreading(track_file, files, parameters, fit_asymmetry=True,
+                  max_evaluations=_default_evaluations):
+    """
+    fits the spreading rate of every period in the spreading rate
+    file and, if fit_asymmetry is True, the asymmetry of every period
+    in the asymmetry file to the anomaly of track_file. Without an
+    asymmetry file the periods of the spreading rate file are used,
+    starting with symmetric spreading. files and parameters are as
+    for run_batch. The fit is a pattern search which changes one
+    period at a time and halves its steps when no change improves
+    the misfit, until the steps are small or max_evaluations models
+    have been computed.
+    Returns a tuple with the fitted periods (as get_period_table
+    returns them) and the misfits before and after fitting:
+    (spread_table, asym_table, initial_misfit, misfit)
+    """
+
+    spread_table = get_period_table(files['spreadingrate'])
+    if files['asymmetry'] is None:
+        asym_table = [(start, end, 0.0) for (start, end, rate) in spread_table]
+    else:
+        asym_table = get_period_table(files['asymmetry'])
+
+    forward = CachedForwardModel(track_file, files, parameters)
+
+    # The values searched, with their steps and limits
+    values = [float(rate) for (start, end, rate) in spread_table]
+    steps = [abs(rate)*_rate_step[0] or 1.0 for rate in values]
+    smallest = [step*_rate_step[1]/_rate_step[0] for step in steps]
+    limits = [(0, None)]*len(values)
+    if fit_asymmetry:
+        values += [float(value) for (start, end, value) in asym_table]
+        steps += [_asymmetry_step[0]]*len(asym_table)
+        smallest += [_asymmetry_step[1]]*len(asym_table)
+        limits += [(-1, 1)]*len(asym_table)
+
+    def tables(values):
+        rates = values[:len(spread_table)]
+        fitted_spread = [(start, end, rate) for ((start, end, old), rate)
+                         in zip(spread_table, rates)]
+        fitted_asym = asym_table
+        if fit_asymmetry:
+            fitted_asym = [(start, end, value) for ((start, end, old), value)
+                           in zip(asym_table, values[len(spread_table):])]
+        return (fitted_spread, fitted_asym)
+
+    def within(value, limit):
+        (lower, upper) = limit
+        return ((lower is None or value > lower) and
+                (upper is None or value < upper))
+
+    initial_misfit = best = forward.misfit(*tables(values))
+    evaluations = 1
+    while evaluations < max_evaluations:
+        searching = [i for i in range(len(values)) if steps[i] >= smallest[i]]
+        if not searching:
+            break
+
+        improved = False
+        for i in searching:
+            for sign in (1, -1):
+                trial = list(values)
+                trial[i] += sign*steps[i]
+                if not within(trial[i], limits[i]):
+                    continue
+                misfit = forward.misfit(*tables(trial))
+                evaluations += 1
+                if misfit < best:
+                    (best, values) = (misfit, trial)
+                    improved = True
+                    break
+
+        if not improved:
+            steps = [step/2 for step in steps]
+
+    (fitted_spread, fitted_asym) = tables(values)
+    return (fitted_spread, fitted_asym, initial_misfit, best)
+
+def write_period_table(table, period_file, value_name):
+    """
+    writes periods (as get_period_table returns them) into
+    period_file in the format the period files are read in
+    """
+
+    f = open(period_file, 'w')
+    f.write('%% start(Myr) end(Myr) %s\n' % value_name)
+    for (start, end, value) in table:
+        f.write('%s %s %s\n' % (start, end, value))
+    f.close()
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+instrument.py - measures the stages of magellan
+
+Copyright (C) 2008 Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, sys, threading
+from timeit import default_timer
+try:
+    import resource
+except ImportError:
+    # Not available on every platform, peak memory is then unknown
+    resource = None
+
+# Output formats of Profile
+formats = ('table', 'json')
+
+# Functions called with the record of every stage that ends
+_hooks = []
+# The stages running in each thread, innermost last
+_local = threading.local()
+
+def add_hook(hook):
+    """
+    calls hook with the record of every stage that ends from now
+    on, in the thread the stage ran in. A record is a dictionary
+    with the keys
+    stage (the name of the stage),
+    wall (seconds from start to end),
+    cpu (seconds of processor time used by the process meanwhile),
+    peak_memory (the most memory the process has used so far,
+    in bytes, or None if it is not known),
+    peak_increase (how much the stage raised peak_memory, in bytes,
+    or None if it is not known) and
+    counts (a dictionary of what the stage counted, e.g. rows).
+    Stages are only measured while there is a hook.
+    """
+
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    """
+    stops calling a hook added with add_hook
+    """
+
+    _hooks.remove(hook)
+
+def enabled():
+    """
+    tells whether stages are measured (there is a hook)
+    """
+
+    return len(_hooks) > 0
+
+def emit(record):
+    """
+    passes a record to every hook, e.g. one measured in another
+    process
+    """
+
+    for hook in list(_hooks):
+        hook(record)
+
+def stage(name):
+    """
+    returns a context manager measuring the stage name while the
+    with statement runs:
+
+        with instrument.stage('timeline'):
+            ...
+            instrument.count('events', len(timeline))
+
+    The record of the stage is passed to the hooks when it ends.
+    Without hooks nothing is measured.
+    """
+
+    if not _hooks:
+        return _unmeasured
+    return _Stage(name)
+
+def measured(name):
+    """
+    returns a decorator which measures every call of a function
+    as the stage name (see stage)
+    """
+
+    def decorate(function):
+        def measured_function(*arguments, **keywords):
+            if not _hooks:
+                return function(*arguments, **keywords)
+            with _Stage(name):
+                return function(*arguments, **keywords)
+        measured_function.__name__ = function.__name__
+        measured_function.__doc__ = function.__doc__
+        return measured_function
+    return decorate
+
+def measured_iter(name, iterable, counted=None):
+    """
+    returns an iterator over iterable which measures the time spent
+    producing its items as the stage name, e.g. a generator consumed
+    by another stage, and counts the items as counted if given. Its
+    one record is passed to the hooks when it is exhausted or closed.
+    Without hooks iterable is iterated unmeasured.
+    """
+
+    if not _hooks:
+        return iter(iterable)
+    return _measured_iterator(_Stage(name), iter(iterable), counted)
+
+def _measured_iterator(stage, iterator, counted):
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    (wall, cpu) = (0.0, 0.0)
+    first_peak = peak_memory()
+    try:
+        while True:
+            # The stage runs only while the next item is produced
+            _local.stack.append(stage)
+            (start_wall, start_cpu) = (default_timer(), _cpu_time())
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                wall += default_timer() - start_wall
+                cpu += _cpu_time() - start_cpu
+                _local.stack.pop()
+            if counted is not None:
+                stage.counts[counted] = stage.counts.get(counted, 0) + 1
+            yield item
+    finally:
+        peak = peak_memory()
+        if peak is None: increase = None
+        else: increase = peak - first_peak
+        emit({'stage':stage.name, 'wall':wall, 'cpu':cpu,
+              'peak_memory':peak, 'peak_increase':increase,
+              'counts':stage.counts})
+
+def count(name, value=1):
+    """
+    adds value to the count name of the innermost stage running
+    in this thread, if it is measured
+    """
+
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        counts = stack[-1].counts
+        counts[name] = counts.get(name, 0) + value
+
+def peak_memory():
+    """
+    returns the most memory the process has used so far in bytes,
+    or None if it is not known
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, Mac OS X bytes
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+def _cpu_time():
+    (user, system) = os.times()[:2]
+    return user + system
+
+class _Stage(object):
+    """
+    A measured stage (see stage)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        self.wall = default_timer()
+        self.cpu = _cpu_time()
+        self.peak = peak_memory()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        wall = default_timer() - self.wall
+        cpu = _cpu_time() - self.cpu
+        peak = peak_memory()
+        if peak is None: increase = None
+        else: increase = peak - self.peak
+        _local.stack.pop()
+        emit({'stage':self.name, 'wall':wall, 'cpu':cpu,
+              'peak_memory':peak, 'peak_increase':increase,
+              'counts':self.counts})
+        return False
+
+class _Unmeasured(object):
+    """
+    A stage which is not measured
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+_unmeasured = _Unmeasured()
+
+class Profile(object):
+    """
+    A hook (see add_hook) which keeps the records of the stages,
+    and summarizes them by stage as a table or in JSON. Stages may
+    run inside each other (e.g. reading the period files while the
+    timeline is computed), so their times overlap.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def start(self):
+        """
+        starts keeping records. Returns the profile.
+        """
+
+        add_hook(self)
+        return self
+
+    def stop(self):
+        """
+        stops keeping records
+        """
+
+        remove_hook(self)
+
+    def summary(self):
+        """
+        sums the records of each stage, in the order the stages
+        first ended. Returns a list of dictionaries with the keys
+        of a record and calls, the number of records summed;
+        peak_memory is the largest of the records and peak_increase
+        the largest increase of a single record.
+        """
+
+        stages = {}
+        order = []
+        for record in self.records:
+            name = record['stage']
+            if name not in stages:
+                order.append(name)
+                stages[name] = {'stage':name, 'calls':0, 'wall':0.0,
+                                'cpu':0.0, 'peak_memory':None,
+                                'peak_increase':None, 'counts':{}}
+            total = stages[name]
+            total['calls'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            for key in ('peak_memory', 'peak_increase'):
+                if record.get(key) is not None:
+                    total[key] = max(total[key], record[key])
+            for (key, value) in record['counts'].items():
+                total['counts'][key] = total['counts'].get(key, 0) + value
+
+        return [stages[name] for name in order]
+
+    def table(self):
+        """
+        returns the summary as a table for people to read. The
+        raised column is how much a call of the stage raised the peak
+        memory of the process at most, the process column that peak.
+        """
+
+        lines = ['%-16s %5s %10s %10s %10s %11s  %s' % ('stage', 'calls',
+                                                         'wall(s)', 'cpu(s)',
+                                                         'raised(MB)',
+                                                         'process(MB)',
+                                                         'counts')]
+        for total in self.summary():
+            memory = []
+            for key in ('peak_increase', 'peak_memory'):
+                if total[key] is None: memory.append('-')
+                else: memory.append('%.1f' % (total[key]/float(1 << 20)))
+            counts = ' '.join(['%s=%d' % item
+                               for item in sorted(total['counts'].items())])
+            lines.append('%-16s %5d %10.4f %10.4f %10s %11s  %s' % (
+                (total['stage'], total['calls'], total['wall'], total['cpu'])
+                + tuple(memory) + (counts,)))
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        """
+        returns the summary and the records as a JSON object with
+        the keys stages and records
+        """
+
+        import json
+        return json.dumps({'stages':self.summary(),
+                           'records':self.records}) + '\n'
+
+    def format(self, format='table'):
+        """
+        returns the profile in one of formats
+        """
+
+        if format not in formats:
+            raise ValueError('unknown profile format %s, choose one of %s'
+                             % (format, ', '.join(formats)))
+        return getattr(self, format)()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""
+model.py - a magnetic anomaly model as an object.
+
+Copyright (C) 2008  Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import numpy as np
+from Magellan.data import *
+from Magellan.calc import *
+from Magellan import calc, data
+from Magellan.cache import digest, file_digest
+
+# Input files a model reads its periods from
+period_files = ('asymmetry', 'spreadingrate', 'jump', 'magnetization',
+                'timescale')
+
+def _period_path(key, filename):
+    """
+    returns the file the periods of key are read from (see the get_*
+    functions in Magellan.data): filename, or the default timescale if
+    no timescale is given
+    """
+
+    if key == 'timescale' and filename is None:
+        return data._default_timescale
+    return filename
+
+class Model(object):
+    """
+    A magnetic anomaly model for one set of period files (asymmetry,
+    spreadingrate, jump, magnetization and timescale) and model
+    parameters (see resolve_parameters). The parameters are resolved
+    when the model is created and cannot be changed afterwards.
+    The stages of the pipeline are methods, each taking the output of
+    the stage before, and run runs all of them for a track.
+    A model keeps no state outside itself and never changes its
+    arguments, so several models can be run in one process and one
+    model can be shared between threads.
+    If a StageCache (see Magellan.cache) is given, the result of every
+    stage is stored in it under a digest of the stage inputs, and read
+    back instead of computed when the same inputs come again. A model
+    with another thickness, for example, only computes the anomaly
+    model anew.
+    """
+
+    def __init__(self, files, parameters=None, cache=None):
+        self._files = tuple([(key, files.get(key)) for key in period_files])
+        self._parameters = resolve_parameters(parameters or {})
+        self._cache = cache
+        self._source = None
+        self._deltax = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled (models are sent to worker processes)
+        return (self._files, self._parameters, self._cache, self._source,
+                self._deltax)
+
+    def __setstate__(self, state):
+        (self._files, self._parameters, self._cache, self._source,
+         self._deltax) = state
+        self._lock = threading.Lock()
+
+    def _memoize(self, key, compute):
+        """
+        returns the result of compute() for a stage, from the cache
+        if the model has one and key (a tuple of the stage name and
+        its inputs) has been computed before
+        """
+
+        if self._cache is None:
+            return compute()
+        return self._cache.memoize(digest(*key), compute)
+
+    def _source_digest(self):
+        """
+        returns a digest of the content of the period files, which
+        every stage up to deltax depends on. Without a cache nothing
+        is looked up by it, so the files are not read and None is
+        returned.
+        """
+
+        if self._cache is None:
+            return None
+        if self._source is None:
+            files = self.files
+            self._source = digest(*[file_digest(_period_path(key, files[key]))
+                                    for key in period_files])
+        return self._source
+
+    @property
+    def files(self):
+        """
+        a copy of the period files of the model
+        """
+
+        return dict(self._files)
+
+    @property
+    def parameters(self):
+        """
+        the resolved parameters of the model (a ModelParameters tuple)
+        """
+
+        return self._parameters
+
+    def periods(self):
+        """
+        reads the period files. Returns a tuple of dictionaries
+        as returned by the get_* functions in Magellan.data:
+        (asymmetry, spreadingrate, jump, magnetization, timescale)
+        """
+
+        files = self.files
+        def compute():
+            return (get_asymmetry(files['asymmetry']),
+                    get_spreadingrate(files['spreadingrate']),
+                    get_jumps(files['jump']),
+                    get_magnetization(files['magnetization']),
+                    get_timescale(files['timescale']))
+
+        return self._memoize(('periods', self._source_digest()), compute)
+
+    def timeline(self):
+        """
+        returns the change timeline (see create_change_timeline)
+        """
+
+        return self._memoize(('timeline', self._source_digest()),
+                             lambda: create_change_timeline(*self.periods()))
+
+    def deltax(self):
+        """
+        returns the distances each half of the ridge has moved (see
+        create_deltax). They do not depend on the track, so they are
+        computed once for the model.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._deltax is None:
+                self._deltax = self._memoize(
+                    ('deltax', self._source_digest()),
+                    lambda: create_deltax(iter_change_timeline(
+                        *self.periods())))
+            return self._deltax
+        finally:
+            self._lock.release()
+
+    def layer_and_faults(self, dist):
+        """
+        creates the magnetized layer and the pseudo faults and failed
+        rifts under a track with distances dist (see
+        create_layer_and_faults). Returns a tuple:
+        (magnetized_layer, faults_and_rifts)
+        """
+
+        (min_l, max_r) = (min(dist), max(dist))
+        def compute():
+            (deltax_l, deltax_r) = self.deltax()
+            return create_layer_and_faults(deltax_l, deltax_r, min_l, max_r)
+
+        return self._memoize(('layer', self._source_digest(), min_l, max_r),
+                             compute)
+
+    def projected_layer(self, magnetized_layer):
+        """
+        projects a magnetized layer with the obliquity of the model
+        (see create_projected_magnetized_layer)
+        """
+
+        obliquity = self._parameters.obliquity
+        return self._memoize(('projected layer', magnetized_layer, obliquity),
+                             lambda: calc._project_layer(magnetized_layer,
+                                                         obliquity))
+
+    def sample_track(self, dist, deep):
+        """
+        returns the distances and depths the anomaly is computed at,
+        the track resampled to the point spacing of the model if it
+        has one (see resample_track): (dist, deep)
+        """
+
+        if self._parameters.pointspacing is None:
+            return (dist, deep)
+        return resample_track(dist, deep, self._parameters.pointspacing)
+
+    def observation_points(self, model_dist, observations):
+        """
+        returns the distances the anomaly is computed at to find it
+        at observations: observations themselves, or the part of
+        the resampled track model_dist (see sample_track) covering
+        them if the model has a point spacing, which the anomaly is
+        then interpolated from
+        """
+
+        if self._parameters.pointspacing is None:
+            return observations
+        return calc._covering(model_dist, observations)
+
+    def anomaly_model(self, dist, deep, projected_layer, observations=None):
+        """
+        computes the anomaly along the projected track, at
+        observations if given (see create_anomaly_model).
+        Returns a list.
+        """
+
+        def compute():
+            return calc._anomaly_model(dist, deep, self._parameters,
+                                       projected_layer, observations).tolist()
+
+        # Everything but the point spacing, which is applied to dist
+        # and deep before
+        if observations is not None:
+            observations = np.asarray(observations, dtype=float)
+        key = ('anomaly model', np.asarray(dist, dtype=float),
+               np.asarray(deep, dtype=float), projected_layer,
+               tuple(self._parameters[:6]), observations)
+        return self._memoize(key, compute)
+
+    def observed_anomaly(self, dist, deep, projected_layer, observations):
+        """
+        computes the anomaly of the track (dist and deep, resampled
+        to the point spacing of the model if it has one) at the
+        distances observations along it, back on the original
+        track. Returns a list with a value for each of observations.
+        """
+
+        (model_dist, model_deep) = self.sample_track(dist, deep)
+        points = self.observation_points(model_dist, observations)
+        anomaly_model = self.inv_project(
+            self.anomaly_model(model_dist, model_deep, projected_layer,
+                               points))
+        if points is not observations:
+            anomaly_model = interpolate_model(points, anomaly_model,
+                                              observations)
+
+        return anomaly_model
+
+    def iter_anomaly_model(self, dist, deep, projected_layer, radius,
+                           window=calc._default_window, observations=None):
+        """
+        computes the anomaly along the projected track window by
+        window, at observations if given (see iter_anomaly_model)
+        """
+
+        return calc._iter_anomaly_model(dist, deep, self._parameters,
+                                        projected_layer, radius, window,
+                                        observations)
+
+    def engine_accuracy(self, dist, deep, projected_layer, engine='parker',
+                        observations=None):
+        """
+        compares an engine to the talwani engine (see engine_accuracy)
+        """
+
+        return calc._engine_accuracy(dist, deep, self._parameters,
+                                     projected_layer, engine, observations)
+
+    def engine_name(self, dist, deep, engine, observations=None):
+        """
+        returns the name of the engine used for engine, the one
+        chosen for the track if engine is auto (see choose_engine)
+        """
+
+        return calc._engine_name(dist, deep,
+                                 self._parameters._replace(engine=engine),
+                                 observations)
+
+    def inv_project(self, anomaly_model):
+        """
+        projects an anomaly model back to the original track
+        (see inv_project_anomaly_model)
+        """
+
+        return calc._inv_project(anomaly_model, self._parameters.obliquity)
+
+    def run(self, dist, deep, observations=None):
+        """
+        runs the whole pipeline for a track with distances dist
+        and depths deep. Returns a tuple with the anomaly model at
+        each of observations (e.g. where the anomaly was measured,
+        dist if not given), the magnetized layer and the pseudo
+        faults and failed rifts:
+        (anomaly_model, magnetized_layer, faults_and_rifts)
+        """
+
+        (magnetized_layer, faults_and_rifts) = self.layer_and_faults(dist)
+        projected_layer = self.projected_layer(magnetized_layer)
+
+        if observations is None:
+            observations = dist
+        anomaly_model = self.observed_anomaly(dist, deep, projected_layer,
+                                              observations)
+
+        return (anomaly_model, magnetized_layer, faults_and_rifts)
@@ -19,162 +19,285 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from pylab import *
+import os, cPickle
+from multiprocessing import Pool
+import numpy as np
 import Magellan
+from Magellan import instrument
 from Magellan.calc import *
 
-_default_thickness = '0.5'
+# matplotlib is only imported when a figure is drawn, so that
+# importing this module (and running magellan without a figure)
+# does not pay for loading it and setting up a backend
+
+_default_format = 'png'
+_figure_size = (12,8)
+
+def _pylab():
+    """
+    imports and returns pylab. Without a display (on compute
+    nodes) pylab must not pick an interactive backend, so the
+    Agg backend is used and figures can only be saved.
+    """
+
+    import matplotlib
+    if os.name == 'posix' and not os.environ.get('DISPLAY'):
+        matplotlib.use('Agg')
+    import pylab
+    return pylab
+
+def _offscreen_figure():
+    """
+    returns a new figure on an Agg canvas of its own, which
+    never touches pylab or the interactive backend, so figures
+    can be saved in any process
+    """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=_figure_size)
+    FigureCanvasAgg(fig)
+    return fig
 
 def create_plot(dist, dist_anom, deep, anom, layer, faultrift, model, parameters):
     """
     Plot bathymetry profiles from distance, depth,
-    anomalies, the magnetic layer and a model.
-    Uses matplotlib to plot a nice graph.
+    anomalies, the magnetic layer and a model (at the
+    distances of the anomalies, dist_anom).
+    Uses matplotlib to plot a nice graph and shows it
+    in a window.
+    """
+
+    thickness = resolve_parameters(parameters).thickness
+
+    with instrument.stage('plot'):
+        pylab = _pylab()
+        fig = pylab.figure(figsize=_figure_size)
+        _draw_plot(fig, dist, dist_anom, deep, anom, layer, faultrift, model,
+                   thickness)
+    pylab.show()
+
+def save_plot(filename, dist, dist_anom, deep, anom, layer, faultrift, model,
+              parameters, dpi=None):
+    """
+    Plots the same figure as create_plot but draws it off
+    screen and writes it to filename instead of showing it,
+    so no display is needed. The format (png, pdf, svg, ...)
+    is taken from the extension of filename and dpi is the
+    resolution (the matplotlib default if None).
+    Returns filename.
+    """
+
+    thickness = resolve_parameters(parameters).thickness
+
+    with instrument.stage('plot'):
+        fig = _offscreen_figure()
+        _draw_plot(fig, dist, dist_anom, deep, anom, layer, faultrift, model,
+                   thickness)
+        fig.savefig(filename, dpi=dpi)
+
+    return filename
+
+def save_results(filename, dist, dist_anom, deep, anom, layer, faultrift,
+                 model, parameters):
+    """
+    writes everything needed to plot a model (the arguments of
+    save_plot) to filename, so the figure can be rendered later
+    with render_plots
+    """
+
+    thickness = resolve_parameters(parameters).thickness
+    results = (list(dist), list(dist_anom), list(deep), list(anom), layer,
+               faultrift, list(model), thickness)
+
+    f = open(filename, 'wb')
+    try:
+        cPickle.dump(results, f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+
+def load_results(filename):
+    """
+    reads results written by save_results. Returns a tuple:
+    (dist, dist_anom, deep, anom, layer, faultrift, model, parameters)
+    """
+
+    f = open(filename, 'rb')
+    try:
+        results = cPickle.load(f)
+    finally:
+        f.close()
+
+    return results[:7] + ({'thickness':results[7]},)
+
+def figure_name(result_file, format=_default_format, output_dir=None):
     """
+    returns the name of the figure of a result file: the result
+    file with its extension replaced by format, in output_dir if
+    it is given and next to the result file otherwise
+    """
+
+    name = os.path.splitext(result_file)[0] + '.' + format
+    if output_dir is not None:
+        name = os.path.join(output_dir, os.path.basename(name))
+    return name
+
+def _render_plot(job):
+    """
+    renders the figure of one result file (see render_plots)
+    """
+
+    (result_file, filename, dpi) = job
+    return save_plot(filename, *load_results(result_file), dpi=dpi)
+
+def render_plots(result_files, format=_default_format, output_dir=None,
+                 dpi=None, processes=None):
+    """
+    renders the figures of many result files (see save_results)
+    off screen, in a pool of processes (as many as there are cpus
+    unless processes is given). Each figure is written in format
+    (png, pdf, svg, ...) to the name given by figure_name.
+    Returns a list of the figure files written.
+    """
+
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = [(result_file, figure_name(result_file, format, output_dir), dpi)
+            for result_file in result_files]
+
+    if processes == 1:
+        return map(_render_plot, jobs)
+
+    pool = Pool(processes)
+    try:
+        figure_files = pool.map(_render_plot, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return figure_files
+
+def create_block_polygons(dist, deep, layer, thickness):
+    """
+    creates the outline of every block in a magnetized layer
+    beneath a track with distances dist and (positive) depths deep.
+    A block follows the bathymetry from its start to its end and is
+    thickness deep. The outlines of all blocks are built in one go.
+    Returns a tuple with a list of (n,2) arrays of the distance and
+    elevation (negative depth) of the corners of each block, top
+    from start to end and then bottom from end to start, and a
+    boolean array telling which blocks are normally polarized:
+    (polygons, normal)
+    """
+
+    if len(layer) == 0:
+        return ([], np.zeros(0, dtype=bool))
+
+    dist = np.asarray(dist, dtype=float)
+    elevation = -np.asarray(deep, dtype=float)
+    bounds = np.array([position for (position,pol,magnet) in layer],
+                      dtype=float)
+    (starts, ends) = (bounds[:,0], bounds[:,1])
+    normal = np.array([pol == 'n' for (position,pol,magnet) in layer])
+
+    track_index = TrackIndex(dist, elevation)
+    # The points of the track within each block, from the next index
+    # above start to the next index below end
+    lower = track_index.upper(starts)
+    upper = track_index.lower(ends)
+    inside = np.maximum(upper - lower + 1, 0)
+    # Finding the excact depth at start and end
+    start_elevation = track_index.depth_at(starts)
+    end_elevation = track_index.depth_at(ends)
+
+    # Each top is start, the points inside and end; the offset of
+    # every top in one array of all tops
+    corners = inside + 2
+    offsets = np.cumsum(corners) - corners
+    top_x = np.empty(corners.sum())
+    top_y = np.empty(corners.sum())
+    top_x[offsets] = starts
+    top_y[offsets] = start_elevation
+    top_x[offsets+corners-1] = ends
+    top_y[offsets+corners-1] = end_elevation
+    # The position of every inside point in the tops and in the track
+    block = np.repeat(np.arange(len(layer)), inside)
+    step = np.arange(inside.sum()) - np.repeat(np.cumsum(inside) - inside,
+                                               inside)
+    top_x[offsets[block]+1+step] = dist[lower[block]+step]
+    top_y[offsets[block]+1+step] = elevation[lower[block]+step]
+
+    polygons = []
+    for (x, y) in zip(np.split(top_x, offsets[1:]),
+                      np.split(top_y, offsets[1:])):
+        polygons.append(np.column_stack(
+            (np.concatenate((x, x[::-1])),
+             np.concatenate((y, y[::-1] - thickness)))))
+
+    return (polygons, normal)
+
+def _draw_plot(fig, dist, dist_anom, deep, anom, layer, faultrift, model,
+               thickness):
+    """
+    draws the anomalies and the bathymetry with the magnetized
+    blocks into fig. deep is not changed.
+    """
+
+    from matplotlib.collections import PolyCollection
+    from matplotlib.transforms import blended_transform_factory
 
-    thickness = eval(parameters.get('thickness', _default_thickness))
-        
-    fig = figure(figsize=(12,8))
     anomplot = fig.add_subplot(211)
     bathplot = fig.add_subplot(212,sharex=anomplot)
     
     anomplot.set_title('Anomalies')
     anomplot.set_ylabel('nT')
     anomplot.plot(dist_anom, anom, '#330099', label="Data")
-    anomplot.plot(dist, model, '#FF9900', label="Model")
+    # The model is at dist_anom, or at dist in older results
+    if len(model) == len(dist_anom):
+        anomplot.plot(dist_anom, model, '#FF9900', label="Model")
+    else:
+        anomplot.plot(dist, model, '#FF9900', label="Model")
     bathplot.set_title('Bathymetry')
     bathplot.set_xlabel('km')
     bathplot.set_ylabel('km')
-    stuff=[]
-    for index in range(len(deep)):
-	deep[index] = deep[index]*-1
-	stuff.append(0)
-
-
-    deepthick = map(lambda x: x-thickness, deep)
-    f=open('blocks','w')
-
-    for ((start,end),polarity,magnet) in layer:
-        if polarity == 'n': fillcolor = 'b'
-        else: fillcolor = 'w'
-
-	# The next index above start
-        index_lower = next_upper(dist,start)
-        # The next index below end        
-	index_upper = next_lower(dist,end)
-
-	# Finding the excact depth at start and end
-	y_start = get_depth(dist,deep,start)
-        y_end = get_depth(dist,deep, end)
-	y_start_lower = y_start-thickness
-        y_end_lower = y_end-thickness
-
-        if (index_lower == index_upper +1):
-	    xs = [start,end]
-	    lys = [y_start, y_end]
-	    tys = [y_start_lower, y_end_lower] 
-        else:
-            xs = [start]+dist[index_lower:index_upper+1]+[end]
-            lys = [y_start]+deep[index_lower:index_upper+1]+[y_end]
-            tys = [y_start_lower]+ deepthick[index_lower:index_upper+1] + [y_end_lower]
-	    
-        x = concatenate( (xs, xs[::-1]) )
-        y = concatenate( (lys, tys[::-1]) )
-	m = []
-	depth = []
-	    
-	if fillcolor == 'b':
-	    for i in range(len(xs)):		
-		m.append(xs[i])	    
-		depth.append(lys[i])
-	if fillcolor == 'w':
-	    for i in range(len(xs)):
-		m.append(xs[i])
-	    	depth.append(-1*lys[i])
-	    ## Producing a file called blocks which can be used to plot up in gmt
-	    
-	if (end >= dist_anom[0] and start <= dist_anom[-1]):
-	    if fillcolor == 'b':
-	        f.write("> -Gblack\n")
-	        for i in range(len(x)):
-	    	    f.write(str(x[i])+ " " + str(y[i]) + "\n")
-	    else:
-	        f.write("> -Gwhite\n")
-	        for i in range(len(x)):
-		    f.write(str(x[i])+ " " + str(y[i]) + "\n")
-          
-	bathplot.fill(x, y, facecolor=fillcolor)
-
-
-
-        #if (index_lower != index_upper):
-            #xs = dist[index_lower:index_upper+1]
-            #lys = deep[index_lower:index_upper+1]
-            #tys = deepthick[index_lower:index_upper+1]
-	    
-            #x = concatenate( (xs, xs[::-1]) )
-            #y = concatenate( (lys, tys[::-1]) )
-	    #m = []
-	    #depth = []
-	    
-	    #if fillcolor == 'b':
-		#for i in range(len(xs)):		
-		    #m.append(xs[i])	    
-		    #depth.append(lys[i])
-	    #if fillcolor == 'w':
-		#for i in range(len(xs)):
-		    #m.append(xs[i])
-	    	    #depth.append(-1*lys[i])
-	    ## Producing a file called blocks which can be used to plot up in gmt
-	    
-	    #if (end >= dist_anom[0] and start <= dist_anom[-1]):
-	    	#if fillcolor == 'b':
-	            #f.write("> -Gblack\n")
-	            #for i in range(len(x)):
-	    	 	#f.write(str(x[i])+ " " + str(y[i]) + "\n")
-	    	#else:
-	            #f.write("> -Gwhite\n")
-	            #for i in range(len(x)):
-			#f.write(str(x[i])+ " " + str(y[i]) + "\n")
-          
-	    #bathplot.fill(x, y, facecolor=fillcolor)
-    f.close()
-    #Fix to get one entry per fault/rift in legend
-    fault_plotted = False
-    rift_plotted = False
+
+    elevation = -np.asarray(deep, dtype=float)
+    (polygons, normal) = create_block_polygons(dist, deep, layer, thickness)
+    instrument.count('blocks', len(polygons))
+    instrument.count('points', len(dist))
+
+    # All blocks are drawn as one collection
+    fillcolors = np.where(normal, 'b', 'w').tolist()
+    bathplot.add_collection(PolyCollection(polygons, facecolors=fillcolors,
+                                           edgecolors='k'))
+
+    # The pseudo faults and failed rifts span the height of both
+    # plots, one collection for each kind on each plot with a single
+    # legend entry
     dx = 0.3
-    for (position,fault,rift) in faultrift:
-        if fault:
-            anomplot.axvspan(position-dx,position+dx,
-            		     facecolor='#339900',edgecolor='none')
-            if fault_plotted:
-                bathplot.axvspan(position-dx,position+dx,
-            	    	         facecolor='#339900',edgecolor='none')
-            else:
-                bathplot.axvspan(position-dx,position+dx,
-            	    	         facecolor='#339900',edgecolor='none',
-            	    	         label="Pseudofault")
-                fault_plotted = True
-        if rift:
-            anomplot.axvspan(position-dx,position+dx,
-            		     facecolor='r',edgecolor='none')
-            if rift_plotted:
-                bathplot.axvspan(position-dx,position+dx,
-            		         facecolor='r',edgecolor='none')
-            else:
-                bathplot.axvspan(position-dx,position+dx,
-            		         facecolor='r',edgecolor='none',
-            	    	         label="Failed rift")
-            	rift_plotted = True
-
- 
-    bathplot.plot(dist, deep, linewidth=2)
-    anomplot.plot(dist, stuff, linewidth=0.5)
+    for (kind, color, label) in ((1, '#339900', "Pseudofault"),
+                                 (2, 'r', "Failed rift")):
+        positions = [fr[0] for fr in faultrift if fr[kind]]
+        if not positions:
+            continue
+        spans = [((position-dx,0), (position-dx,1),
+                  (position+dx,1), (position+dx,0))
+                 for position in positions]
+        for (axes, legend_label) in ((anomplot, None), (bathplot, label)):
+            transform = blended_transform_factory(axes.transData,
+                                                  axes.transAxes)
+            axes.add_collection(PolyCollection(spans, facecolors=color,
+                                               edgecolors='none',
+                                               transform=transform,
+                                               label=legend_label),
+                                autolim=False)
+
+    bathplot.plot(dist, elevation, linewidth=2)
+    anomplot.plot(dist, np.zeros(len(dist)), linewidth=0.5)
     bathplot.set_xlim(min(dist_anom),max(dist_anom))
-    bathplot.set_ylim(min(deepthick),0)
+    bathplot.set_ylim(elevation.min()-thickness,0)
     #anomplot.set_ylim(-100,100)
     anomplot.legend()
     bathplot.legend()
-
-    show()
-
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+sweep.py - fits a track over a grid of model parameters
+
+Copyright (C) 2008 Tryggvi Björgvinsson <tryggvib@hi.is>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from math import cos, radians, sqrt
+from multiprocessing import Pool
+import numpy as np
+from Magellan.data import *
+from Magellan.calc import *
+from Magellan import calc
+
+# Parameters which can be swept and their defaults
+sweep_parameters = ('inclination', 'declination', 'azimuth',
+                    'thickness', 'obliquity')
+_defaults = {'inclination':calc._default_inclination,
+             'declination':calc._default_declination,
+             'azimuth':calc._default_azimuth,
+             'thickness':calc._default_thickness,
+             'obliquity':calc._default_obliquity}
+
+# Inputs shared by every grid point a worker process evaluates
+_shared = {}
+
+def parse_range(text):
+    """
+    parses a range of parameter values. The range is either
+    a single value, a comma separated list of values or
+    start:stop:step where stop is included if the steps
+    reach it. Returns a list of values.
+    """
+
+    text = text.strip()
+    if ':' in text:
+        (start, stop, step) = [float(value) for value in text.split(':')]
+        if step == 0:
+            raise ValueError('step of range %s is zero' % text)
+        count = int(np.floor((stop - start)/step + 1e-9)) + 1
+        return [start + i*step for i in range(max(count, 0))]
+
+    return [float(value) for value in text.split(',')]
+
+def create_grid(parameters):
+    """
+    creates the ranges of every swept parameter from a
+    dictionary of parameters (as given on the command line
+    or in a configuration file), using the default value for
+    parameters which are not given.
+    Returns a dictionary {parameter:[values]}
+    """
+
+    grid = {}
+    for key in sweep_parameters:
+        grid[key] = parse_range(parameters.get(key, _defaults[key]))
+
+    return grid
+
+def misfit(model, anomaly):
+    """
+    returns the root mean square difference between a model
+    and the observed anomaly at the same points
+    """
+
+    difference = np.asarray(model) - np.asarray(anomaly)
+    return sqrt(np.mean(difference**2))
+
+def _init_worker(dist, deep, dist_anom, anom, mag_layer, directions, terms):
+    """
+    stores the inputs shared by all grid points in the worker process
+    """
+
+    _shared['track'] = (dist, deep, dist_anom, anom)
+    _shared['layer'] = mag_layer
+    _shared['directions'] = directions
+    _shared['terms'] = terms
+
+def _evaluate(job):
+    """
+    evaluates every field direction for one obliquity and
+    thickness. The geometry of the magnetized blocks only
+    depends on those two, so it is computed once and the
+    directions only cost a few array operations each.
+    Returns a list of rows:
+    [(inclination, declination, azimuth, thickness, obliquity, misfit)]
+    """
+
+    (obliquity, thickness) = job
+    (dist, deep, dist_anom, anom) = _shared['track']
+    factor = cos(radians(obliquity))
+
+    projected_dist = [distance*factor for distance in dist]
+    segments = calc._anomaly_segments(
+        projected_dist, deep,
+        calc._project_layer(_shared['layer'], radians(obliquity)))
+    # The anomaly is only needed where it was measured
+    observations = np.asarray(dist_anom, dtype=float)*factor
+    (P, Q) = calc._talwani_geometry(segments, observations, thickness,
+                                    calc._contam, terms=_shared['terms'])
+
+    rows = []
+    for (inclination, declination, azimuth) in _shared['directions']:
+        model = calc._talwani_field(P, Q, radians(inclination),
+                                    radians(declination), radians(azimuth))
+        # Back to the original track
+        model = model/factor
+        rows.append((inclination, declination, azimuth, thickness,
+                     obliquity, misfit(model, anom)))
+
+    return rows
+
+def run_sweep(track_file, files, parameters, processes=None):
+    """
+    models track_file for every combination of the swept
+    parameters and measures the misfit to the observed anomaly.
+    files is a dictionary with the asymmetry, jump, magnetization,
+    spreadingrate and timescale files and parameters a dictionary
+    with the ranges of the swept parameters (see parse_range).
+    The engine is taken from parameters, an engine without terms
+    (see register_engine) is replaced by the default one.
+    The magnetized layer is computed once. Every obliquity and
+    thickness pair is evaluated by a pool of processes (as many as
+    there are cpus unless processes is given).
+    Returns a list of rows sorted by misfit, best fit first:
+    [(inclination, declination, azimuth, thickness, obliquity, misfit)]
+    """
+
+    grid = create_grid(parameters)
+
+    asym = get_asymmetry(files['asymmetry'])
+    spread = get_spreadingrate(files['spreadingrate'])
+    jump = get_jumps(files['jump'])
+    magnet = get_magnetization(files['magnetization'])
+    timescale = get_timescale(files['timescale'])
+    (dist, deep, dist_anom, anom) = get_trackdata(track_file)
+
+    timeline = create_change_timeline(asym,spread,jump,magnet,timescale)
+    (delta_l, delta_r) = create_deltax(timeline)
+    mag_layer = create_magnetized_layer(delta_l, delta_r,
+                                        min(dist), max(dist))
+
+    directions = [(inclination, declination, azimuth)
+                  for inclination in grid['inclination']
+                  for declination in grid['declination']
+                  for azimuth in grid['azimuth']]
+    jobs = [(obliquity, thickness)
+            for obliquity in grid['obliquity']
+            for thickness in grid['thickness']]
+    engine = resolve_parameters({'engine':parameters.get('engine')}).engine
+    terms = calc._engine(engine, dist, deep, polygon=True).terms
+    shared = (dist, deep, dist_anom, anom, mag_layer, directions, terms)
+
+    if processes == 1 or len(jobs) == 1:
+        _init_worker(*shared)
+        results = map(_evaluate, jobs)
+    else:
+        pool = Pool(processes, _init_worker, shared)
+        try:
+            results = pool.map(_evaluate, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    rows = [row for result in results for row in result]
+    rows.sort(key=lambda row: row[-1])
+
+    return rows
+
+def write_misfit_table(rows, table_file):
+    """
+    writes the rows returned by run_sweep into table_file,
+    one grid point per line, best fit first
+    """
+
+    f = open(table_file, 'w')
+    f.write('% inclination declination azimuth thickness obliquity misfit(nT)\n')
+    for row in rows:
+        f.write(' '.join([str(value) for value in row]) + '\n')
+    f.close()